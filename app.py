@@ -2,10 +2,14 @@ import streamlit as st
 import numpy as np
 from PIL import Image
 import cv2
-from fpdf import FPDF
+import io
+import json
 import os
+import threading
 from datetime import datetime
 
+from shade_core import shade_systems, get_closest_shades, roi_average_lab, generate_pdf
+
 # ---------------------- Setup ----------------------
 st.set_page_config(page_title="AffoDent Tooth Shade Matcher", layout="centered")
 st.title("🦷 AffoDent Tooth Shade Matcher")
@@ -13,92 +17,79 @@ st.title("🦷 AffoDent Tooth Shade Matcher")
 DATA_DIR = "patient_data"
 os.makedirs(DATA_DIR, exist_ok=True)
 
-# ---------------------- Shade Guides ----------------------
-vita_classical = {
-    "A1": (255, 240, 220), "A2": (240, 224, 200), "A3": (225, 205, 185),
-    "A3.5": (210, 190, 170), "B1": (250, 235, 210), "B2": (235, 215, 190),
-    "C1": (220, 200, 180), "C2": (205, 185, 165), "D2": (200, 180, 160)
-}
-
-vita_3d_master = {
-    "1M1": (255, 243, 224), "2M1": (246, 231, 209), "2M2": (235, 219, 198),
-    "3M2": (225, 205, 185), "3R2.5": (210, 190, 170), "4M1": (200, 180, 160)
-}
-
-ivoclar_chromascop = {
-    "100": (255, 240, 220), "200": (245, 225, 205), "300": (230, 210, 190),
-    "400": (215, 195, 175), "500": (200, 180, 160)
-}
-
-shade_systems = {
-    "Vita Classical": vita_classical,
-    "Vita 3D-Master": vita_3d_master,
-    "Ivoclar Chromascop": ivoclar_chromascop
-}
-
 # ---------------------- Utilities ----------------------
 
-def rgb_to_lab(rgb):
-    rgb_arr = np.uint8([[list(rgb)]])
-    lab = cv2.cvtColor(rgb_arr, cv2.COLOR_RGB2LAB)
-    return lab[0][0]
-
-def find_closest_shade(input_rgb, system_dict):
-    input_lab = rgb_to_lab(input_rgb)
-    closest, min_dist = None, float("inf")
-    for shade, ref_rgb in system_dict.items():
-        ref_lab = rgb_to_lab(ref_rgb)
-        dist = np.linalg.norm(input_lab - ref_lab)
-        if dist < min_dist:
-            min_dist, closest = dist, shade
-    return closest
-
-def generate_pdf(name, sex, age, results, image_path, manual_override=None):
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_font("Arial", size=14)
-
-    pdf.cell(200, 10, txt="AffoDent Professional Dental Clinic", ln=True, align='C')
-    pdf.set_font("Arial", size=12)
-    pdf.ln(5)
-    pdf.cell(200, 10, f"Name: {name}", ln=True)
-    pdf.cell(200, 10, f"Sex: {sex}", ln=True)
-    pdf.cell(200, 10, f"Age: {age}", ln=True)
-
-    pdf.ln(5)
-    pdf.cell(200, 10, "🦷 Detected Shades:", ln=True)
-    for system, shade in results.items():
-        pdf.cell(200, 10, f"• {system}: {shade}", ln=True)
-
-    if manual_override:
-        pdf.ln(5)
-        pdf.set_text_color(255, 0, 0)
-        pdf.cell(200, 10, f"Manual Override: {manual_override}", ln=True)
-        pdf.set_text_color(0, 0, 0)
-
-    if image_path and os.path.exists(image_path):
-        pdf.image(image_path, w=100)
-
-    pdf_path = os.path.join(DATA_DIR, f"{name.replace(' ', '_')}_report.pdf")
-    pdf.output(pdf_path)
-    return pdf_path
-
-def save_patient_data(name, data):
-    records = load_patient_data()
-    records = [r for r in records if r["name"] != name]
-    records.insert(0, data)
-    records = records[:10]
-    with open(os.path.join(DATA_DIR, "records.txt"), "w") as f:
-        for r in records:
-            f.write(str(r) + "\n")
-
+MAX_IMAGE_DIM = 1024
+
+@st.cache_data
+def load_image(data: bytes) -> np.ndarray:
+    # Multi-MP phone photos add nothing for shade sampling; bound the
+    # decoded size so downstream work scales with MAX_IMAGE_DIM, not the
+    # upload resolution.
+    image = Image.open(io.BytesIO(data))
+    # For JPEGs, draft mode tells libjpeg to decode at a reduced scale
+    # instead of decompressing every MCU at full resolution
+    image.draft("RGB", (MAX_IMAGE_DIM, MAX_IMAGE_DIM))
+    image = image.convert("RGB")
+    image.thumbnail((MAX_IMAGE_DIM, MAX_IMAGE_DIM), Image.Resampling.BILINEAR)
+    return np.asarray(image, dtype=np.uint8)
+
+@st.cache_data(max_entries=32)
+def analyze(image_bytes: bytes, systems: tuple):
+    # All per-submission work (decode, ROI sample, LAB convert, match)
+    # lives here so widget tweaks after submission reuse the cached result
+    # instead of re-running the pipeline on every rerun.
+    img_array = load_image(image_bytes)
+    h, w = img_array.shape[:2]
+    # Sample a small ROI around the center rather than a single pixel
+    r = max(1, min(h, w) // 20)
+    roi = img_array[max(0, h//2 - r):h//2 + r, max(0, w//2 - r):w//2 + r]
+    if roi.size == 0:
+        # Degenerate crop (e.g. 1-pixel-high image): average the whole frame
+        roi = img_array
+    input_lab = roi_average_lab(roi)
+    center_rgb = tuple(int(v) for v in cv2.mean(roi)[:3])
+    return get_closest_shades(input_lab, systems), center_rgb
+
+RECORDS_PATH = os.path.join(DATA_DIR, "records.jsonl")
+MAX_RECORDS = 10
+
+def save_patient_data(data):
+    # Append-only: one JSON line per save instead of rewriting the file
+    with open(RECORDS_PATH, "a") as f:
+        f.write(json.dumps(data) + "\n")
+    load_patient_data.clear()
+    # Compact occasionally so the log doesn't grow without bound
+    if os.path.getsize(RECORDS_PATH) > 256 * 1024:
+        records, _ = load_patient_data()
+        with open(RECORDS_PATH, "w") as f:
+            for r in reversed(records):
+                f.write(json.dumps(r) + "\n")
+        load_patient_data.clear()
+
+@st.cache_data(ttl=5)
 def load_patient_data():
-    path = os.path.join(DATA_DIR, "records.txt")
-    if not os.path.exists(path):
-        return []
-    with open(path, "r") as f:
-        lines = f.readlines()
-        return [eval(line.strip()) for line in lines]
+    # Returns (records, lowered names) as one cached pair so the search
+    # filter can never zip rows from two different cache generations
+    if not os.path.exists(RECORDS_PATH):
+        return [], []
+    with open(RECORDS_PATH) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    # Latest entry per name wins, newest first, capped like the old file
+    seen, latest = set(), []
+    for r in reversed(records):
+        if r["name"] not in seen:
+            seen.add(r["name"])
+            latest.append(r)
+    latest = latest[:MAX_RECORDS]
+    # Lowercased once per load instead of per record per keystroke
+    return latest, [r["name"].lower() for r in latest]
+
+@st.cache_data(max_entries=64)
+def stored_pdf_bytes(path: str, mtime: float) -> bytes:
+    # mtime keys the cache so a regenerated report invalidates its entry
+    with open(path, "rb") as f:
+        return f.read()
 
 # ---------------------- Main App ----------------------
 
@@ -112,18 +103,12 @@ with st.form("form"):
     submitted = st.form_submit_button("🔍 Submit")
 
 if submitted and uploaded_file:
-    image = Image.open(uploaded_file).convert("RGB")
-    img_array = np.array(image)
-    h, w = img_array.shape[:2]
-    center_rgb = tuple(img_array[h//2, w//2])  # Sample from center
+    image_bytes = uploaded_file.getvalue()
+    image = Image.fromarray(load_image(image_bytes))
+    results, center_rgb = analyze(image_bytes, tuple(selected_systems))
     st.image(image, caption="Uploaded Image", use_column_width=True)
     st.markdown(f"🎯 Sampled RGB at center: `{center_rgb}`")
 
-    results = {}
-    for system_name in selected_systems:
-        closest = find_closest_shade(center_rgb, shade_systems[system_name])
-        results[system_name] = closest
-
     final_manual = manual_override if manual_override != "None" else None
     st.success("✅ Shade Matching Complete")
     for sys, shade in results.items():
@@ -131,15 +116,26 @@ if submitted and uploaded_file:
     if final_manual:
         st.info(f"✍️ Manual override selected: `{final_manual}`")
 
-    # Save image
-    img_path = os.path.join(DATA_DIR, f"{name.replace(' ', '_')}_image.jpg")
-    image.save(img_path)
+    # The upload is already an encoded JPEG/PNG, so keep the raw bytes
+    # instead of paying a full re-encode through Pillow
+    suffix = os.path.splitext(uploaded_file.name)[1].lower()
+    if suffix in (".jpg", ".jpeg", ".png"):
+        img_bytes = image_bytes
+        img_path = os.path.join(DATA_DIR, f"{name.replace(' ', '_')}_image{suffix}")
+    else:
+        buf = io.BytesIO()
+        image.save(buf, format="JPEG")
+        img_bytes = buf.getvalue()
+        img_path = os.path.join(DATA_DIR, f"{name.replace(' ', '_')}_image.jpg")
+
+    pdf_bytes = generate_pdf(name, sex, age, results, image, final_manual)
+    pdf_path = os.path.join(DATA_DIR, f"{name.replace(' ', '_')}_report.pdf")
 
-    # Save report
-    pdf_path = generate_pdf(name, sex, age, results, img_path, final_manual)
+    # Hand the bytes to the download button right away; disk persistence
+    # happens in the background so the user never waits on file I/O
+    st.download_button("📄 Download PDF Report", pdf_bytes, file_name=os.path.basename(pdf_path))
 
-    # Save data
-    save_patient_data(name, {
+    record = {
         "name": name,
         "sex": sex,
         "age": age,
@@ -148,22 +144,30 @@ if submitted and uploaded_file:
         "image_path": img_path,
         "pdf_path": pdf_path,
         "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M")
-    })
+    }
+
+    def _persist():
+        with open(img_path, "wb") as f:
+            f.write(img_bytes)
+        with open(pdf_path, "wb") as f:
+            f.write(pdf_bytes)
+        save_patient_data(record)
 
-    with open(pdf_path, "rb") as f:
-        st.download_button("📄 Download PDF Report", f, file_name=os.path.basename(pdf_path))
+    threading.Thread(target=_persist, daemon=True).start()
 
 # ---------------------- Search History ----------------------
 
 st.markdown("## 📁 View Previous Reports")
-records = load_patient_data()
+records, lowered = load_patient_data()
 search_query = st.text_input("🔍 Search by Name")
-filtered = [r for r in records if search_query.lower() in r["name"].lower()]
+q = search_query.lower()
+filtered = [records[i] for i, n in enumerate(lowered) if q in n]
 
 for r in filtered:
     st.markdown(f"**{r['name']}** ({r['age']} yrs, {r['sex']}) - *{r['timestamp']}*")
     st.markdown(", ".join([f"{k}: {v}" for k, v in r["results"].items()]))
     if r["manual"]:
         st.markdown(f"✍️ Manual override: `{r['manual']}`")
-    with open(r["pdf_path"], "rb") as f:
-        st.download_button(f"📄 Download Report - {r['name']}", f, file_name=os.path.basename(r["pdf_path"]))
+    if os.path.exists(r["pdf_path"]):
+        data = stored_pdf_bytes(r["pdf_path"], os.path.getmtime(r["pdf_path"]))
+        st.download_button(f"📄 Download Report - {r['name']}", data, file_name=os.path.basename(r["pdf_path"]))
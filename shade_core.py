@@ -0,0 +1,274 @@
+"""Shared shade-matching core: reference guides, precomputed LAB tables,
+the closest-shade kernel, and PDF report generation.
+
+Kept free of Streamlit so every app page imports one copy of the tables
+and kernels instead of redefining them.
+"""
+
+import io
+from functools import lru_cache
+
+import numpy as np
+import cv2
+from fpdf import FPDF
+from fpdf.enums import XPos, YPos
+
+# ---------------------- Shade Guides ----------------------
+
+vita_classical = {
+    "A1": (255, 240, 220), "A2": (240, 224, 200), "A3": (225, 205, 185),
+    "A3.5": (210, 190, 170), "B1": (250, 235, 210), "B2": (235, 215, 190),
+    "C1": (220, 200, 180), "C2": (205, 185, 165), "D2": (200, 180, 160)
+}
+
+vita_3d_master = {
+    "1M1": (255, 243, 224), "2M1": (246, 231, 209), "2M2": (235, 219, 198),
+    "3M2": (225, 205, 185), "3R2.5": (210, 190, 170), "4M1": (200, 180, 160)
+}
+
+ivoclar_chromascop = {
+    "100": (255, 240, 220), "200": (245, 225, 205), "300": (230, 210, 190),
+    "400": (215, 195, 175), "500": (200, 180, 160)
+}
+
+shade_systems = {
+    "Vita Classical": vita_classical,
+    "Vita 3D-Master": vita_3d_master,
+    "Ivoclar Chromascop": ivoclar_chromascop
+}
+
+# Reference colors are static, so they are converted to LAB once at
+# import, in a flat structure-of-arrays layout: one contiguous int16
+# (N,3) table, a parallel name list, and a slice per system into both.
+# Matching any system is then a sweep over one small contiguous block.
+SHADE_KEYS = {name: list(d.keys()) for name, d in shade_systems.items()}
+SHADE_NAMES = [shade for d in shade_systems.values() for shade in d]
+SHADE_LAB = cv2.cvtColor(
+    np.array([rgb for d in shade_systems.values() for rgb in d.values()],
+             dtype=np.uint8).reshape(-1, 1, 3),
+    cv2.COLOR_RGB2LAB).reshape(-1, 3).astype(np.int16)
+SHADE_SYSTEM_SLICES = {}
+_start = 0
+for _name, _d in shade_systems.items():
+    SHADE_SYSTEM_SLICES[_name] = slice(_start, _start + len(_d))
+    _start += len(_d)
+del _name, _d, _start
+
+# Coarse 32x32x32 color lookup table per system (32 KB each): every RGB
+# bin is matched to its winning shade, so single-pixel queries become
+# one array index with no cvtColor or distance search. Built lazily on
+# first use and memoized for the life of the process, so importing the
+# module (every cold start) doesn't pay for tables no page queries.
+@lru_cache(maxsize=None)
+def _clut(system_name):
+    # Bin centers, not lower edges, to halve the quantization error
+    grid = np.arange(4, 256, 8, dtype=np.uint8)
+    cube = np.stack(np.meshgrid(grid, grid, grid, indexing="ij"), axis=-1)
+    lab = cv2.cvtColor(cube.reshape(1, -1, 3), cv2.COLOR_RGB2LAB).reshape(-1, 3).astype(np.int32)
+    table = SHADE_LAB[SHADE_SYSTEM_SLICES[system_name]]
+    d2 = ((lab[:, None, :] - table[None].astype(np.int32)) ** 2).sum(axis=-1, dtype=np.int32)
+    return d2.argmin(axis=1).astype(np.uint8).reshape(32, 32, 32)
+
+# ---------------------- Matching ----------------------
+
+# System boundaries within the flat table, in offset form for the fused
+# multi-system kernel.
+_SYSTEM_ORDER = list(shade_systems)
+_LAB_OFFSETS = np.array([SHADE_SYSTEM_SLICES[s].start for s in _SYSTEM_ORDER]
+                        + [len(SHADE_NAMES)], dtype=np.int32)
+
+try:
+    from numba import njit
+
+    @njit(cache=True, fastmath=True)
+    def closest_idx(lab_ref, lab_in):
+        best, bi = 1e18, 0
+        for i in range(lab_ref.shape[0]):
+            d = ((lab_ref[i, 0] - lab_in[0]) ** 2
+                 + (lab_ref[i, 1] - lab_in[1]) ** 2
+                 + (lab_ref[i, 2] - lab_in[2]) ** 2)
+            if d < best:
+                best, bi = d, i
+        return bi
+
+    @njit(cache=True, fastmath=True)
+    def match_all(lab_in, table, offsets):
+        # One pass over the concatenated table, local argmin per system
+        out = np.empty(offsets.shape[0] - 1, dtype=np.int32)
+        for k in range(offsets.shape[0] - 1):
+            best, bi = 1 << 40, offsets[k]
+            for i in range(offsets[k], offsets[k + 1]):
+                d = ((table[i, 0] - lab_in[0]) ** 2
+                     + (table[i, 1] - lab_in[1]) ** 2
+                     + (table[i, 2] - lab_in[2]) ** 2)
+                if d < best:
+                    best, bi = d, i
+            out[k] = bi - offsets[k]
+        return out
+
+    # Warm the JIT once at import so Streamlit reruns never pay compile cost
+    closest_idx(SHADE_LAB[SHADE_SYSTEM_SLICES["Vita Classical"]], np.zeros(3, dtype=np.int32))
+    match_all(np.zeros(3, dtype=np.int32), SHADE_LAB, _LAB_OFFSETS)
+except ImportError:
+    def closest_idx(lab_ref, lab_in):
+        diffs = lab_ref.astype(np.int32) - lab_in
+        # Max squared distance is 3*255^2, so an int32 accumulator is
+        # plenty; the default would widen to the platform int64
+        return int(np.argmin((diffs * diffs).sum(axis=1, dtype=np.int32)))
+
+    def match_all(lab_in, table, offsets):
+        diffs = table.astype(np.int32) - lab_in
+        d2 = (diffs * diffs).sum(axis=1, dtype=np.int32)
+        return np.array([int(d2[offsets[k]:offsets[k + 1]].argmin())
+                         for k in range(len(offsets) - 1)], dtype=np.int32)
+
+
+def rgb_to_lab(rgb):
+    # Direct sRGB -> XYZ -> LAB on the three scalars, scaled to OpenCV's
+    # 8-bit LAB convention (L*255/100, a+128, b+128). A 1x1 cvtColor call
+    # spends orders of magnitude more on dispatch than on this arithmetic;
+    # the result tracks cvtColor within +/-2 counts across the RGB cube.
+    r, g, b = (c / 255.0 for c in rgb)
+    r, g, b = (((v + 0.055) / 1.055) ** 2.4 if v > 0.04045 else v / 12.92
+               for v in (r, g, b))
+    x = (0.412453 * r + 0.357580 * g + 0.180423 * b) / 0.950456
+    y = 0.212671 * r + 0.715160 * g + 0.072169 * b
+    z = (0.019334 * r + 0.119193 * g + 0.950227 * b) / 1.088754
+    fx, fy, fz = (t ** (1 / 3) if t > 0.008856 else 7.787 * t + 16 / 116
+                  for t in (x, y, z))
+    L = 116 * fy - 16 if y > 0.008856 else 903.3 * y
+    return np.array([round(L * 255 / 100),
+                     round(500 * (fx - fy)) + 128,
+                     round(200 * (fy - fz)) + 128], dtype=np.uint8)
+
+
+# Above this size a shade library is searched through an L*-sorted
+# window instead of the dense sweep; shades differ mostly in lightness,
+# so a narrow window prunes most candidates. The stock guides are far
+# smaller and stay on the dense kernel.
+_WINDOW_MIN_SHADES = 64
+_L_WINDOW = 16
+
+@lru_cache(maxsize=None)
+def _l_sorted(system_name):
+    table = SHADE_LAB[SHADE_SYSTEM_SLICES[system_name]]
+    order = np.argsort(table[:, 0], kind="stable")
+    return np.ascontiguousarray(table[order]), order
+
+def _closest_windowed(system_name, lab):
+    table, order = _l_sorted(system_name)
+    L_col = table[:, 0]
+    w = _L_WINDOW
+    while w <= 512:
+        lo = int(np.searchsorted(L_col, lab[0] - w))
+        hi = int(np.searchsorted(L_col, lab[0] + w, side="right"))
+        if hi > lo:
+            local = closest_idx(np.ascontiguousarray(table[lo:hi]), lab)
+            best = table[lo + local].astype(np.int32)
+            # Anything outside the window differs by >= w in L* alone, so
+            # a winner within w*w is globally optimal; otherwise widen
+            if int(((best - lab) ** 2).sum()) <= w * w:
+                return int(order[lo + local])
+        w *= 2
+    return int(order[closest_idx(table, lab)])
+
+def find_closest_shade_lab(input_lab, system_name):
+    # Squared distance has the same argmin as the L2 norm, no sqrt needed.
+    # Rounding the input to int keeps the whole reduction in integer lanes
+    # (int16 table, int32 accumulation) with no float promotion; references
+    # are >10 LAB units apart so sub-unit rounding never flips the winner.
+    lab = np.asarray(np.rint(input_lab), dtype=np.int32)
+    sl = SHADE_SYSTEM_SLICES[system_name]
+    if sl.stop - sl.start > _WINDOW_MIN_SHADES:
+        idx = _closest_windowed(system_name, lab)
+    else:
+        idx = closest_idx(SHADE_LAB[sl], lab)
+    return SHADE_KEYS[system_name][idx]
+
+
+def get_closest_shades(input_lab, systems=None):
+    # Round the input once, then one fused sweep matches every system
+    lab = np.asarray(np.rint(input_lab), dtype=np.int32)
+    idxs = match_all(lab, SHADE_LAB, _LAB_OFFSETS)
+    if systems is None:
+        systems = _SYSTEM_ORDER
+    return {
+        system: SHADE_KEYS[system][int(idxs[_SYSTEM_ORDER.index(system)])]
+        for system in systems
+    }
+
+
+def find_closest_shade(input_rgb, system_name):
+    r, g, b = (int(v) for v in input_rgb)
+    idx = _clut(system_name)[r >> 3, g >> 3, b >> 3]
+    return SHADE_KEYS[system_name][idx]
+
+
+def roi_average_lab(roi):
+    # One batched RGB->LAB conversion of the whole ROI, then average in LAB.
+    # Averaging after the conversion avoids the nonlinear sRGB->LAB error
+    # that averaging in RGB first would introduce.
+    roi = np.ascontiguousarray(roi)
+    lab_roi = cv2.cvtColor(roi, cv2.COLOR_RGB2LAB)
+    flat = lab_roi.reshape(-1, 3)
+    # Restrict to likely tooth pixels (bright, low saturation) so gum
+    # tissue and shadow in the crop don't pollute the average; fall back
+    # to every pixel when the threshold keeps too few of them
+    mask = cv2.inRange(cv2.cvtColor(roi, cv2.COLOR_RGB2HSV),
+                       (0, 0, 120), (180, 60, 255))
+    if cv2.countNonZero(mask) >= max(1, mask.size // 4):
+        flat = flat[mask.reshape(-1) > 0]
+    n = flat.shape[0]
+    k = n // 10
+    if k == 0:
+        # ROI too small to trim; plain mean of the kept pixels
+        return flat.mean(axis=0)
+    # 10% trimmed mean per channel: specular highlights and shadow pixels
+    # drag a plain mean, and np.partition keeps this O(n) without a sort
+    out = np.empty(3)
+    for c in range(3):
+        v = np.partition(flat[:, c], [k, n - k - 1])[k:n - k]
+        out[c] = v.mean()
+    return out
+
+
+# ---------------------- Report ----------------------
+
+def generate_pdf(name, sex, age, results, image=None, manual_override=None):
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font("helvetica", size=14)
+
+    pdf.cell(200, 10, text="AffoDent Professional Dental Clinic", align='C',
+             new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.set_font("helvetica", size=12)
+    pdf.ln(5)
+    pdf.cell(200, 10, f"Name: {name}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.cell(200, 10, f"Sex: {sex}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.cell(200, 10, f"Age: {age}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+
+    pdf.ln(5)
+    # fpdf's core fonts are latin-1 only; keep PDF text to plain ASCII
+    pdf.cell(200, 10, "Detected Shades:", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    for system, shade in results.items():
+        pdf.cell(200, 10, f"- {system}: {shade}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+
+    if manual_override:
+        pdf.ln(5)
+        pdf.set_text_color(255, 0, 0)
+        pdf.cell(200, 10, f"Manual Override: {manual_override}",
+                 new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+        pdf.set_text_color(0, 0, 0)
+
+    if image is not None:
+        # The image renders ~100 mm wide, so bound it and embed as JPEG
+        # rather than letting fpdf2 store the full frame losslessly
+        thumb = image.copy()
+        thumb.thumbnail((1200, 1200))
+        buf = io.BytesIO()
+        thumb.save(buf, format="JPEG", quality=80, optimize=True)
+        buf.seek(0)
+        pdf.image(buf, w=100)
+
+    # Render in memory; the caller decides what (if anything) hits disk
+    return bytes(pdf.output())